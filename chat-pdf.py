@@ -1,8 +1,21 @@
 import os
-import faiss
-from sentence_transformers import SentenceTransformer
+
+# Must be set before faiss/torch load their OpenMP/BLAS runtimes, some builds default to 1 thread
+os.environ.setdefault("OMP_NUM_THREADS", str(os.cpu_count() or 1))
+
+import re
+import json
+import mmap
+import hashlib
+import math
+import platform
+import time
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from pathlib import Path
+import numpy as np
 from dotenv import load_dotenv
-from transformers import pipeline
 
 # Load environment variables from .env
 load_dotenv()
@@ -11,122 +24,369 @@ load_dotenv()
 API_KEY = os.getenv("DEEPSEEK_API_KEY")
 DEEPSEEK_URL = os.getenv("DEEPSEEK_URL")
 MODEL_NAME = os.getenv("MODEL")
+# "onnx" runs the embedding model through ONNX Runtime, "torch" through PyTorch
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "onnx")
+# Use the INT8 dynamically quantized ONNX export; set to 0 to compare against FP32
+EMBEDDING_QUANTIZED = os.getenv("EMBEDDING_QUANTIZED", "1") != "0"
+
+# Extracted text, embeddings and indexes are stored here, keyed by file content
+CACHE_DIR = ".cache"
+# Files larger than this are identified by their size plus first and last MB
+PARTIAL_HASH_MIN_SIZE = 64 * 1024 * 1024
+PARTIAL_HASH_BLOCK = 1024 * 1024
+
+
+# faiss, torch, sentence_transformers and transformers are imported where they
+# are used: PDF extraction workers re-run this module's top level under the
+# spawn start method (Windows, macOS) and must not pay for those imports
+def configure_threads():
+    import faiss
+    import torch
+    # PyTorch and FAISS may default to fewer threads than available cores; OMP_NUM_THREADS
+    # defaults to the CPU count above, but a value set by the user is respected
+    num_threads = int(os.environ["OMP_NUM_THREADS"])
+    torch.set_num_threads(num_threads)
+    faiss.omp_set_num_threads(num_threads)
 
 
 # 1. Read and split the book into chunks
+WORD_RE = re.compile(r"\S+")
+
+
 def split_into_chunks(text, max_words=200):
-    words = text.split()
+    # Slice each chunk straight out of the text instead of building a word list
     chunks = []
-    for i in range(0, len(words), max_words):
-        chunk = " ".join(words[i:i + max_words])
-        chunks.append(chunk)
+    count = start = end = 0
+    for match in WORD_RE.finditer(text):
+        if count == 0:
+            start = match.start()
+        end = match.end()
+        count += 1
+        if count == max_words:
+            chunks.append(text[start:end])
+            count = 0
+    if count:
+        chunks.append(text[start:end])
     return chunks
 
 
 # 2. Generate embeddings for each chunk
-def get_embeddings(chunks_list, embedding_model):
-    return embedding_model.encode(chunks_list, show_progress_bar=True)
+def cpu_features():
+    try:
+        from numpy._core._multiarray_umath import __cpu_features__
+    except ImportError:
+        try:
+            from numpy.core._multiarray_umath import __cpu_features__
+        except ImportError:
+            return {}
+    return __cpu_features__
+
+
+def embedding_model_file():
+    # The hub repo ships one INT8 export per instruction set; without a match
+    # (or with quantization disabled) the FP32 model.onnx is used
+    if EMBEDDING_BACKEND != "onnx":
+        return None
+    if EMBEDDING_QUANTIZED:
+        if platform.machine().lower() in ("arm64", "aarch64"):
+            return "model_qint8_arm64.onnx"
+        features = cpu_features()
+        if features.get("AVX512VNNI"):
+            return "model_qint8_avx512_vnni.onnx"
+        if features.get("AVX2"):
+            return "model_quint8_avx2.onnx"
+    return "model.onnx"
+
+
+def embedding_variant():
+    # Embeddings from different backends/model files are not interchangeable,
+    # so this is part of the cache file names
+    file_name = embedding_model_file()
+    return EMBEDDING_BACKEND if file_name is None else f"{EMBEDDING_BACKEND}-{file_name[:-len('.onnx')]}"
 
 
-# 3. Index embeddings with FAISS
-def create_faiss_index(embeddings_array):
-    dim = embeddings_array.shape[1]
-    index = faiss.IndexFlatL2(dim)
+@lru_cache(maxsize=None)
+def load_embedding_model(name="all-MiniLM-L6-v2"):
+    from sentence_transformers import SentenceTransformer
+    file_name = embedding_model_file()
+    model_kwargs = {"file_name": f"onnx/{file_name}"} if file_name else None
+    return SentenceTransformer(name, backend=EMBEDDING_BACKEND, model_kwargs=model_kwargs)
+
+
+def get_embeddings(chunks_list, embedding_model, batch_size=None):
+    if batch_size is None:
+        # The ONNX backend runs on the CPU, so only a PyTorch model on a GPU gets the larger batch
+        on_gpu = EMBEDDING_BACKEND == "torch" and embedding_model.device.type == "cuda"
+        batch_size = 128 if on_gpu else 32
+    # encode() sorts the inputs by length before batching, so every batch is
+    # padded to similar-length chunks and results come back in input order
+    return embedding_model.encode(chunks_list, batch_size=batch_size, show_progress_bar=True,
+                                  convert_to_numpy=True, normalize_embeddings=True)
+
+
+# 3. Index embeddings with FAISS (HNSW graph instead of a brute-force scan)
+# Above this many chunks the vectors are product-quantized (IVF-PQ) so the
+# index stays small enough to be cache friendly
+PQ_MIN_CHUNKS = 20_000
+
+
+def create_faiss_index(embeddings_array, hnsw_m=32, ef_construction=200, ef_search=64,
+                       pq_m=48, nprobe=10):
+    import faiss
+    n, dim = embeddings_array.shape
+    if n >= PQ_MIN_CHUNKS and dim % pq_m == 0:
+        nlist = max(100, int(math.sqrt(n)))
+        index = faiss.index_factory(dim, f"IVF{nlist},PQ{pq_m}")
+        index.train(embeddings_array)
+        index.add(embeddings_array)
+        index.nprobe = nprobe
+        return index
+    index = faiss.IndexHNSWFlat(dim, hnsw_m)
+    index.hnsw.efConstruction = ef_construction
+    index.hnsw.efSearch = ef_search
     index.add(embeddings_array)
     return index
 
 
 # 4. Search for the most relevant chunks
-def search_relevant_chunks(question, embedding_model, index, chunks_list, k=5):
-    emb_question = embedding_model.encode([question])
-    D, I = index.search(emb_question, k)
-    return [chunks_list[i] for i in I[0]]
+# Below this many chunks a single matrix-vector product over the normalized
+# embeddings is faster than going through a FAISS index, so none is built.
+# Must not exceed PQ_MIN_CHUNKS, or a trained IVF-PQ index would go unused
+EXACT_SEARCH_MAX_CHUNKS = 10_000
+
+
+def search_relevant_chunks(question, embedding_model, index, chunks_list, k=5, ef_search=None,
+                           embeddings=None, rerank_factor=4):
+    emb_question = embedding_model.encode([question], convert_to_numpy=True, normalize_embeddings=True)
+    if embeddings is not None and (index is None or len(embeddings) < EXACT_SEARCH_MAX_CHUNKS):
+        # Embeddings are unit length, so the dot product ranks like L2 distance
+        scores = embeddings @ emb_question[0]
+        if k < len(scores):
+            ids = np.argpartition(-scores, k)[:k]
+        else:
+            ids = np.arange(len(scores))
+        ids = ids[np.argsort(-scores[ids])]
+        return [chunks_list[i] for i in ids]
+    # efSearch must be at least k for the graph search to return k results
+    if hasattr(index, "hnsw"):
+        index.hnsw.efSearch = max(ef_search or index.hnsw.efSearch, k)
+    import faiss
+    quantized = isinstance(index, faiss.IndexIVFPQ)
+    D, I = index.search(emb_question, k * rerank_factor if quantized else k)
+    # FAISS pads with -1 when fewer than k neighbours are found
+    ids = I[0][I[0] >= 0]
+    if quantized and embeddings is not None:
+        # Re-rank the PQ shortlist with exact distances on the original vectors
+        exact = ((embeddings[ids] - emb_question) ** 2).sum(axis=1)
+        ids = ids[np.argsort(exact)]
+    return [chunks_list[i] for i in ids[:k]]
 
 
 # 5. Build prompt and query local model
+@lru_cache(maxsize=None)
+def load_qa_pipeline(model="deepset/roberta-base-squad2"):
+    from transformers import pipeline
+    return pipeline("question-answering", model=model)
+
+
 def query_local_qa(context, question, qa_pipeline=None):
     if qa_pipeline is None:
-        qa_pipeline = pipeline("question-answering", model="deepset/roberta-base-squad2")
-    result = qa_pipeline(question=question, context=context)
+        qa_pipeline = load_qa_pipeline()
+    # A 384-token window with 128 tokens of overlap covers the retrieved chunks;
+    # the best span across all windows is returned, or "" if none answers it
+    result = qa_pipeline(question=question, context=context, top_k=1, max_seq_len=384, doc_stride=128,
+                         handle_impossible_answer=True)
     return result["answer"]
 
 
+# Search for the full sentence containing the answer
+# A sentence ends at a period followed by whitespace, so the periods in "1.5"
+# or "$3.2 million" do not split it; a period after a single capital letter
+# ("U.S.", "J. Smith") is treated as an abbreviation. Single newlines are PDF
+# line wraps, so only a blank line ends a sentence without a period
+SENTENCE_END_RE = re.compile(r"(?<=\.)(?<!\b[A-Z]\.)\s+|\s*\n\s*\n\s*")
+
+
+def find_full_sentence(chunks_list, answer):
+    # Split into sentences and search each for the literal answer; with no
+    # wildcards around the answer this stays linear (no regex backtracking)
+    answer = answer.strip()
+    if not answer:
+        return answer
+    # Whole words only, so "tax" does not match "taxes"; lookarounds instead of
+    # \b so answers starting or ending with "$" or "." still match
+    # Chunks keep the PDF's line wraps, so any run of whitespace in the answer
+    # matches any run of whitespace in the text
+    answer_body = r"\s+".join(re.escape(word) for word in answer.split())
+    answer_re = re.compile(r"(?<!\w)" + answer_body + r"(?!\w)", flags=re.IGNORECASE)
+    matches = []
+    for chunk in chunks_list:
+        # Only chunks that contain the answer as whole words are split into sentences
+        if answer_re.search(chunk):
+            matches.extend(sentence for sentence in SENTENCE_END_RE.split(chunk) if answer_re.search(sentence))
+    if matches:
+        # Show the longest sentence found, joining its wrapped lines
+        return " ".join(max(matches, key=len).split())
+    return answer
+
+
 # Example usage with PDF or TXT support
-def extract_text_pdf(pdf_path):
+def file_cache_key(path):
+    size = os.path.getsize(path)
+    file_hash = hashlib.blake2b(digest_size=16)
+    if size == 0:
+        # mmap cannot map an empty file
+        return file_hash.hexdigest()
+    with open(path, "rb") as f:
+        if size < PARTIAL_HASH_MIN_SIZE and hasattr(hashlib, "file_digest"):
+            # Python 3.11+: hashed in C over a reused buffer, without holding the GIL
+            return hashlib.file_digest(f, lambda: file_hash).hexdigest()
+        # Hash straight from the page cache instead of copying the file into Python bytes
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if size < PARTIAL_HASH_MIN_SIZE:
+                file_hash.update(mm)
+            else:
+                # Keep startup constant-time for very large files
+                file_hash.update(str(size).encode())
+                file_hash.update(mm[:PARTIAL_HASH_BLOCK])
+                file_hash.update(mm[-PARTIAL_HASH_BLOCK:])
+    return file_hash.hexdigest()
+
+
+def cached_file_key(path):
+    # Reuse the stored content hash while the file's size and mtime are unchanged,
+    # so the common case costs one stat() instead of reading the whole file
+    stat = os.stat(path)
+    real_path = os.path.realpath(path)
+    manifest_path = Path(CACHE_DIR, "keys.json")
+    try:
+        manifest = json.loads(manifest_path.read_bytes())
+    except (FileNotFoundError, ValueError):
+        manifest = {}
+    entry = manifest.get(real_path)
+    if entry and entry[:2] == [stat.st_size, stat.st_mtime_ns]:
+        return entry[2]
+    key = file_cache_key(path)
+    manifest[real_path] = [stat.st_size, stat.st_mtime_ns, key]
+    manifest_path.write_bytes(json.dumps(manifest).encode("utf-8"))
+    return key
+
+
+# Worker processes only pay off when the serial extraction would take longer than
+# this; each spawned worker re-imports this module and pdfplumber
+PARALLEL_MIN_SECONDS = 5.0
+# Pages extracted in-process to measure the per-page cost
+PARALLEL_PROBE_PAGES = 4
+
+
+def pages_text(pdf, start, stop):
+    parts = []
+    for page in pdf.pages[start:stop]:
+        parts.append(page.extract_text() or "")
+        parts.append("\n")
+    return "".join(parts)
+
+
+def extract_pages_text(pdf_path, start, stop):
+    import pdfplumber
+    with pdfplumber.open(pdf_path) as pdf:
+        return pages_text(pdf, start, stop)
+
+
+def extract_text_pdf(pdf_path, max_workers=None):
     import pdfplumber
-    extracted_text = ""
     with pdfplumber.open(pdf_path) as pdf:
-        for page in pdf.pages:
-            extracted_text += page.extract_text() or ""
-            extracted_text += "\n"
-    return extracted_text
+        num_pages = len(pdf.pages)
+        probe = min(PARALLEL_PROBE_PAGES, num_pages)
+        started = time.perf_counter()
+        head = pages_text(pdf, 0, probe)
+        per_page = (time.perf_counter() - started) / max(probe, 1)
+        remaining = num_pages - probe
+        max_workers = min(max_workers or os.cpu_count() or 1, remaining)
+        if per_page * remaining < PARALLEL_MIN_SECONDS or max_workers <= 1:
+            return head + pages_text(pdf, probe, num_pages)
+    # One contiguous page range per worker, so each process opens the PDF only once
+    step = math.ceil(remaining / max_workers)
+    starts = range(probe, num_pages, step)
+    stops = [min(start + step, num_pages) for start in starts]
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        return head + "".join(executor.map(extract_pages_text, repeat(pdf_path), starts, stops))
 
 
 if __name__ == "__main__":
-    import numpy as np
+    import faiss
 
+    configure_threads()
     file = input("Enter the book file name (.txt or .pdf): ").strip()
-    if file.lower().endswith(".pdf"):
-        txt_cache = file[:-4] + ".txt"
-    elif file.lower().endswith(".txt"):
-        txt_cache = file
-    else:
+    if not file.lower().endswith((".pdf", ".txt")):
         print("Unsupported file format. Use .txt or .pdf")
         exit(1)
 
-    # Extract text only if necessary
-    if file.lower().endswith(".pdf") and not os.path.exists(txt_cache):
+    # Cache files are named after the file content, so edited files are never served stale
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    cache_prefix = os.path.join(CACHE_DIR, cached_file_key(file))
+    txt_cache = cache_prefix + ".txt"
+
+    # Extract text only if necessary; whole-file byte I/O avoids the text layer's buffering
+    if file.lower().endswith(".txt"):
+        file_text = Path(file).read_bytes().decode("utf-8")
+    elif not os.path.exists(txt_cache):
         print("Extracting text from PDF...")
         file_text = extract_text_pdf(file)
-        with open(txt_cache, "w", encoding="utf-8") as f:
-            f.write(file_text)
+        Path(txt_cache).write_bytes(file_text.encode("utf-8"))
     else:
-        with open(txt_cache, "r", encoding="utf-8") as f:
-            file_text = f.read()
+        file_text = Path(txt_cache).read_bytes().decode("utf-8")
 
     # Chunks
     chunks = split_into_chunks(file_text)
     print(f"Generated chunks: {len(chunks)}")
 
     # Cache files for embeddings and index
-    emb_cache = txt_cache + ".embeddings.npy"
-    faiss_cache = txt_cache + ".faiss"
+    emb_cache = f"{cache_prefix}-{embedding_variant()}.embeddings.npy"
+    faiss_cache = f"{cache_prefix}-{embedding_variant()}.faiss"
+
+    embedding_model_instance = load_embedding_model()
 
-    embedding_model_instance = SentenceTransformer("all-MiniLM-L6-v2")
+    # Small documents are searched exactly over the embeddings; only larger ones get a FAISS index
+    use_index = len(chunks) >= EXACT_SEARCH_MAX_CHUNKS
+    faiss_index = None
 
-    # If embedding and index files exist, load them
-    if os.path.exists(emb_cache) and os.path.exists(faiss_cache):
-        print("Loading embeddings and FAISS index from cache...")
-        embeddings = np.load(emb_cache)
-        faiss_index = faiss.read_index(faiss_cache)
+    # If the cached files exist, load them
+    if os.path.exists(emb_cache) and (not use_index or os.path.exists(faiss_cache)):
+        print("Loading embeddings from cache...")
+        # Stored as float16 to halve the file; FAISS and numpy search need float32.
+        # Mapping the file lets the cast read it directly, so only the float32 copy is allocated
+        embeddings = np.load(emb_cache, mmap_mode="r").astype(np.float32)
+        if use_index:
+            # IVF-PQ inverted lists are mapped from the file instead of copied into memory
+            faiss_index = faiss.read_index(faiss_cache, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
     else:
-        print("Generating embeddings and FAISS index...")
+        print("Generating embeddings...")
         embeddings = get_embeddings(chunks, embedding_model_instance)
         embeddings = np.array(embeddings).astype("float32")
-        faiss_index = create_faiss_index(embeddings)
-        np.save(emb_cache, embeddings)
-        faiss.write_index(faiss_index, faiss_cache)
-
-    # Ask question
-    question = input("What topic do you want to ask about?: ")
-    relevant_chunks = search_relevant_chunks(question, embedding_model_instance, faiss_index, chunks, k=20)
-    context = "\n".join(relevant_chunks)
-    print("Running local QA model...")
-    qa_pipeline = pipeline("question-answering", model="deepset/roberta-base-squad2")
-    answer = query_local_qa(context, question, qa_pipeline)
-    # Search for the full sentence containing the answer
-    import re
-
-
-    def find_full_sentence(context, answer):
-        # Search for the sentence containing the answer
-        pattern = r'([^.\n]*?\b' + re.escape(answer) + r'\b[^.\n]*[.\n])'
-        matches = re.findall(pattern, context, flags=re.IGNORECASE)
-        if matches:
-            # Show the longest sentence found
-            return max(matches, key=len).strip()
-        return answer
-
+        np.save(emb_cache, embeddings.astype(np.float16))
+        if use_index:
+            print("Building FAISS index...")
+            faiss_index = create_faiss_index(embeddings)
+            faiss.write_index(faiss_index, faiss_cache)
 
-    enriched = find_full_sentence(context, answer)
-    print("\nLocal Model's Answer (enriched):\n", enriched)
+    # Ask questions until an empty one, reusing the loaded models
+    while True:
+        try:
+            question = input("What topic do you want to ask about? (leave empty to exit): ").strip()
+        except (EOFError, KeyboardInterrupt):
+            # Ctrl-D/Ctrl-C, or the end of piped input
+            print()
+            break
+        if not question:
+            break
+        relevant_chunks = search_relevant_chunks(question, embedding_model_instance, faiss_index, chunks, k=5,
+                                                 embeddings=embeddings)
+        context = "\n".join(relevant_chunks)
+        print("Running local QA model...")
+        answer = query_local_qa(context, question, load_qa_pipeline())
+        if not answer:
+            print("\nNo answer found in the document.")
+            continue
+        enriched = find_full_sentence(relevant_chunks, answer)
+        print("\nLocal Model's Answer (enriched):\n", enriched)
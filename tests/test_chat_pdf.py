@@ -0,0 +1,48 @@
+import importlib.util
+from pathlib import Path
+
+# chat-pdf.py is a script, not an importable module name
+spec = importlib.util.spec_from_file_location("chat_pdf", Path(__file__).resolve().parent.parent / "chat-pdf.py")
+chat_pdf = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(chat_pdf)
+
+# Text as pdfplumber extracts it: one line break per PDF line
+PDF_TEXT = (
+    "Taxpayer segmentation. Previous research suggests that there are a variety of factors\n"
+    "that can be used to segment taxpayers into different groups, including\n"
+    "risk of noncompliance, compliance motivation, and perception of fairness.\n"
+    "The top marginal tax rate rose to 1.5 percent in 2020.\n"
+)
+WRAPPED_SENTENCE = (
+    "Previous research suggests that there are a variety of factors that can be used to segment "
+    "taxpayers into different groups, including risk of noncompliance, compliance motivation, "
+    "and perception of fairness."
+)
+
+
+def test_split_into_chunks_keeps_word_groups():
+    chunks = chat_pdf.split_into_chunks(PDF_TEXT, max_words=10)
+    words = PDF_TEXT.split()
+    assert [chunk.split() for chunk in chunks] == [words[i:i + 10] for i in range(0, len(words), 10)]
+
+
+def test_find_full_sentence_returns_sentence_wrapped_across_lines():
+    chunks = chat_pdf.split_into_chunks(PDF_TEXT)
+    assert chat_pdf.find_full_sentence(chunks, "taxpayers") == WRAPPED_SENTENCE
+
+
+def test_find_full_sentence_matches_answer_spanning_line_break():
+    chunks = chat_pdf.split_into_chunks(PDF_TEXT)
+    answer = "different groups, including\nrisk of noncompliance"
+    assert chat_pdf.find_full_sentence(chunks, answer) == WRAPPED_SENTENCE
+
+
+def test_find_full_sentence_keeps_periods_inside_answers():
+    chunks = chat_pdf.split_into_chunks(PDF_TEXT)
+    assert chat_pdf.find_full_sentence(chunks, "1.5 percent") == "The top marginal tax rate rose to 1.5 percent in 2020."
+
+
+def test_find_full_sentence_matches_whole_words_only():
+    chunks = chat_pdf.split_into_chunks(PDF_TEXT)
+    assert chat_pdf.find_full_sentence(chunks, "tax") == "The top marginal tax rate rose to 1.5 percent in 2020."
+    assert chat_pdf.find_full_sentence(chunks, "segment tax") == "segment tax"